@@ -5,23 +5,28 @@ import os
 import json
 import glob
 import subprocess
+import concurrent.futures
 import threading
 import sys
-import queue
+import collections
 import signal
-import select
+import selectors
 import socket
 
 MAX_WRITE_QUEUE_LEN = 100 # how many messages to hold in write queue before starting to drop messages
+MAX_DEBUG_QUEUE_LEN = 1000 # how many debug lines to hold when output does not keep up
 
-repeatLock = threading.Lock()
 continue_work = True
 reader_threads = []
 writer_threads = []
 debug_flag = False
+debug_queue = collections.deque() # (file descriptor, bytes) pairs waiting for debug_logger
+debug_wakeup = threading.Event()
 
 def main():
     global debug_flag
+    global writer_threads
+    logger_thread = None
     config_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), "config.json")
     with open(config_file) as json_file:    
         configurations = json.load(json_file)
@@ -29,6 +34,8 @@ def main():
     if "DEBUG" in configurations:
         if configurations["DEBUG"].upper() in ["YES", "TRUE"]:
             debug_flag = True
+            logger_thread = debug_logger()
+            logger_thread.start()
 
     # we map physical usb ports to ttyUSB# hooks. This hack also works with usb hubs. This way You can be sure
     # that when udev decides to map serial converters in some other way, Your configuration stays stable.
@@ -37,11 +44,17 @@ def main():
     # returns something like:
     # /devices/pci0000:00/0000:00:14.0/usb3/3-3/3-3.4/3-3.4.3/3-3.4.3.1/3-3.4.3.1:1.0/ttyUSB1/tty/ttyUSB1
     # This strings prefix 'til "ttyUSB" represents physical usb port on chassis or on usb hub.
-    for dev_hook in glob.iglob("/dev/ttyUSB*"):
-        config = match_configuration(get_udev_path(dev_hook), configurations)
+    # udevadm calls are run in parallel, as every call means fork and exec
+    dev_hooks = list(glob.iglob("/dev/ttyUSB*"))
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        udev_paths = list(executor.map(get_udev_path, dev_hooks))
+
+    for dev_hook, udev_path in zip(dev_hooks, udev_paths):
+        config = match_configuration(udev_path, configurations)
         if config is not None:
             new_reader_thread = nmea0183_reader(dev_hook, config, repeat_message)
             new_writer_thread = nmea0183_writer(new_reader_thread.ser, config)
+            new_reader_thread.writer = new_writer_thread
             new_writer_thread.start()            
             new_reader_thread.start()
             writer_threads.append(new_writer_thread)
@@ -55,6 +68,9 @@ def main():
             new_tcp_server_thread.start()
             writer_threads.append(new_tcp_server_thread)
 
+    # writers don't change after startup
+    writer_threads = tuple(writer_threads)
+
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGHUP, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
@@ -63,21 +79,82 @@ def main():
         r_thread.join()
     for w_thread in writer_threads:
         w_thread.join()
+    # logger goes last, so it can write out what other threads left in debug_queue
+    if logger_thread is not None:
+        logger_thread.stop()
+        logger_thread.join()
 
     print("{}: Normal exit.".format(sys.argv[0]), file=sys.stderr)
 
-def repeat_message(name, message):
+# source is the writer of the port message came from, so we don't echo message back there
+def repeat_message(source, message):
     global debug_flag
     if debug_flag:
-        repeatLock.acquire()
-        print("FROM {}: {}".format(name, message), end="")
+        debug_log(sys.stdout, "FROM {}: ".format(source.name).encode("iso-8859-1") + message)
 
+    # message type is taken out once here, not by every writer
+    message_type = message[3:6]
     for writer in writer_threads:
-        if writer.name != name:
-            writer.send(message)
+        if writer is not source:
+            writer.send(message_type, message)
+
+# debug output is written by debug_logger thread, so slow terminal does not hold up repeating
+# when output is blocked we drop lines, like writers drop messages
+def debug_log(file, line):
+    if len(debug_queue) < MAX_DEBUG_QUEUE_LEN:
+        debug_queue.append((file.fileno(), line))
+        debug_wakeup.set()
+
+# daemon, so blocked output does not keep forced exit waiting. On normal exit main() stops and joins it.
+class debug_logger(threading.Thread):
+    def __init__(self):
+        threading.Thread.__init__(self, daemon=True)
+        self.name = "debug_logger"
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+        debug_wakeup.set()
 
-    if debug_flag:
-        repeatLock.release()
+    def run(self):
+        while not self.stopped:
+            debug_wakeup.wait()
+            debug_wakeup.clear()
+            while debug_queue:
+                fd, line = debug_queue.popleft()
+                os.write(fd, line)
+        # lines may have been added between last drain and stop()
+        while debug_queue:
+            fd, line = debug_queue.popleft()
+            os.write(fd, line)
+
+# returns (accept_messages, deny_messages) of config as frozensets of bytes, at most one of them not None.
+# when both are configured, denied types are taken out of accepted ones here, so per message
+# there is a single set lookup at most.
+def message_filter(config):
+    accept = None
+    deny = None
+    if "accept_messages" in config:
+        accept = frozenset(m.encode("iso-8859-1") for m in config["accept_messages"])
+    if "deny_messages" in config and config["deny_messages"]: # empty deny list denies nothing
+        deny = frozenset(m.encode("iso-8859-1") for m in config["deny_messages"])
+
+    if accept is not None:
+        if deny is not None:
+            accept = accept - deny
+        return accept, None
+    return None, deny
+
+# binds writer.send to send_any, send_accepted or send_not_denied of writer, depending on what config
+# filters. So per message there is only the check config asks for, and none when nothing is filtered.
+def bind_send(writer, config):
+    writer.accept_messages, writer.deny_messages = message_filter(config)
+    if writer.accept_messages is not None:
+        writer.send = writer.send_accepted
+    elif writer.deny_messages is not None:
+        writer.send = writer.send_not_denied
+    else:
+        writer.send = writer.send_any
 
 def match_configuration(udev_path, configurations):
     for config in configurations["configurations"]:
@@ -101,6 +178,34 @@ def signal_handler(sig, frame):
     if sig in [signal.SIGINT, signal.SIGTERM, signal.SIGHUP]:
         print("{}: Preparing for exit.. Signal again to force.".format(sys.argv[0]), file=sys.stderr)
         continue_work = False
+        # threads block without timeout, wake them up so they see continue_work
+        for r_thread in reader_threads:
+            r_thread.stop()
+        for w_thread in writer_threads:
+            w_thread.stop()
+
+# collects incoming bytes into a fixed buffer and hands out complete sentences.
+# unfinished sentence is moved to the start of the buffer, so buffer is not reallocated per sentence.
+class nmea0183_line_buffer:
+    def __init__(self, size=256):
+        self.buf = bytearray(size)
+        self.pos = 0
+
+    def feed(self, data):
+        end = self.pos + len(data)
+        self.buf[self.pos:end] = data # grows the buffer only if sentence does not fit
+        lines = []
+        start = 0
+        newline = self.buf.find(b'\n', self.pos, end)
+        while newline >= 0:
+            lines.append(bytes(self.buf[start:newline + 1]))
+            start = newline + 1
+            newline = self.buf.find(b'\n', start, end)
+        remaining = end - start
+        if start > 0 and remaining > 0:
+            self.buf[0:remaining] = self.buf[start:end]
+        self.pos = remaining
+        return lines
 
 class nmea0183_reader(threading.Thread):
     def __init__(self, port, config, callback):
@@ -109,19 +214,26 @@ class nmea0183_reader(threading.Thread):
         self.config = config
         self.callback = callback
         self.name = config["name"] + "_reader"
-        self.ser = serial.Serial(self.port, int(self.config["port_speed"]), timeout=1)
+        self.writer = None # writer of the same port, set by main() before start
+        self.ser = serial.Serial(self.port, int(self.config["port_speed"]), timeout=None)
+
+    def stop(self):
+        self.ser.cancel_read()
         
     def run(self):        
-        charbuf = bytearray()
+        # hot loop, so attributes are looked up once
+        ser = self.ser
+        read = ser.read
+        feed = nmea0183_line_buffer().feed
+        callback = self.callback
+        writer = self.writer
         while continue_work:
-            chars = self.ser.read(size=1024) # blocks until timeout is reached. Timeout is defined when creating serial.Serial object.
+            # take everything that is already waiting in one go. When nothing is waiting, we block
+            # until next byte arrives or stop() cancels the read.
+            chars = read(size=max(1, ser.in_waiting))
             if len(chars) > 0:
-                for char in chars:
-                    charbuf.extend(char)
-                    if char == b'\n':
-                        line = charbuf.decode("iso-8859-1")
-                        self.callback(self.config["name"], line)
-                        charbuf.clear()
+                for line in feed(chars):
+                    callback(writer, line)
 
 class nmea0183_writer(threading.Thread):
     def __init__(self, ser, config):
@@ -129,43 +241,50 @@ class nmea0183_writer(threading.Thread):
         self.ser = ser
         self.config = config
         self.name = config["name"]
-        self.write_queue = queue.Queue()
+        self.write_queue = collections.deque(maxlen=MAX_WRITE_QUEUE_LEN)
+        self.wakeup = threading.Event()
      
-        if "accept_messages" in config:
-            self.accept_messages = set(config["accept_messages"])
-        else:
-            self.accept_messages = None
-
-        if "deny_messages" in config:
-            self.deny_messages = set(config["deny_messages"])
-        else:
-            self.deny_messages = None
+        bind_send(self, config)
         
 
+    def stop(self):
+        self.wakeup.set()
+
     def run(self):
+        write = self.ser.write
+        write_queue = self.write_queue
+        popleft = write_queue.popleft
+        wakeup = self.wakeup
         while continue_work:
-            try:            
-                message = self.write_queue.get(block=True, timeout=1)
-                self.ser.write(bytes(message, "iso-8859-1"))
-            except queue.Empty:
-                pass
+            wakeup.wait()
+            wakeup.clear()
+            # deque append and popleft are atomic, so readers can keep adding while we drain.
+            # everything queued so far goes out with a single write.
+            messages = []
+            while write_queue:
+                messages.append(popleft())
+            if messages:
+                write(b"".join(messages))
             
 
-    def send(self, message):
-        message_type = message[3:6]
-        if self.accept_messages is not None:
-            if message_type not in self.accept_messages:
-                return
-        if self.deny_messages is not None:
-            if message_type in self.deny_messages:
-                return
-
-        # we drop messages when queue size builds up
-        if self.write_queue.qsize() < MAX_WRITE_QUEUE_LEN:
-            self.write_queue.put(message)
+    # one of send_* is bound as send() in __init__
+    def send_accepted(self, message_type, message):
+        if message_type in self.accept_messages:
+            self.send_any(message_type, message)
+
+    def send_not_denied(self, message_type, message):
+        if message_type not in self.deny_messages:
+            self.send_any(message_type, message)
+
+    def send_any(self, message_type, message):
+        # we drop messages when queue size builds up. Several readers may call this at once, so the
+        # length check is only advisory. Deque maxlen is the hard limit: queue never grows past it.
+        if len(self.write_queue) < MAX_WRITE_QUEUE_LEN:
+            self.write_queue.append(message)
+            self.wakeup.set()
         else:
             if debug_flag:
-                print("{}: ERR: Dropping messages to {}".format(sys.argv[0], self.name), file=sys.stderr)
+                debug_log(sys.stderr, "{}: ERR: Dropping messages to {}\n".format(sys.argv[0], self.name).encode("utf-8"))
 
 class nmea0183_tcp_server(threading.Thread):
     def __init__(self, config, callback):
@@ -174,116 +293,170 @@ class nmea0183_tcp_server(threading.Thread):
         self.config = config
         self.callback = callback
         self.name = config["name"]
-        self.write_queue = queue.Queue()
         tcpport = int(config["network_port"])
         
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server.setblocking(0)        
         self.server.bind(('0.0.0.0', tcpport))
-        self.server.listen(5)
-        self.inputs = [self.server]
-        self.outputs = []
+        self.server.listen(128)
+        # stop() writes to this pipe to break out of select()
+        self.shutdown_read, self.shutdown_write = os.pipe()
+        self.shutdown_lock = threading.Lock() # run() closes the pipe, stop() must not write to closed one
+        # server socket and shutdown pipe are registered without data, clients carry their line buffer as key data
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.server, selectors.EVENT_READ)
+        self.selector.register(self.shutdown_read, selectors.EVENT_READ)
         self.message_queues = {}
+        # bytes socket did not take on last send, per client. Only used by this thread, so no lock.
+        self.unsent_data = {}
         self.message_queues_lock = threading.Lock()
-        self.line_buffers = {}
 
-        if "accept_messages" in config:
-            self.accept_messages = set(config["accept_messages"])
-        else:
-            self.accept_messages = None
+        bind_send(self, config)
 
-        if "deny_messages" in config:
-            self.deny_messages = set(config["deny_messages"])
-        else:
-            self.deny_messages = None
+    def stop(self):
+        self.shutdown_lock.acquire()
+        if self.shutdown_write is not None:
+            os.write(self.shutdown_write, b"\0")
+        self.shutdown_lock.release()
 
     def run(self):
-        while self.inputs and continue_work:
-            readable, writable, exceptional = select.select(self.inputs, self.outputs, self.inputs, 0.3)
-            for s in readable:
-                if s is self.server:
+        select = self.selector.select
+        server = self.server
+        callback = self.callback
+        send = self.send
+        message_queues = self.message_queues
+        message_queues_lock = self.message_queues_lock
+        unsent_data = self.unsent_data
+        while continue_work:
+            for key, mask in select():
+                s = key.fileobj
+                if s is server:
                     connection, client_address = s.accept()
                     connection.setblocking(0)
-                    self.inputs.append(connection)
-                    self.message_queues_lock.acquire()
-                    self.message_queues[connection] = queue.Queue()
-                    self.message_queues_lock.release()
-                else:                    
-                    data = s.recv(1024)
-                    if data:
-                        if s not in self.line_buffers:
-                            self.line_buffers[s] = bytearray()
-                        
-                        for char in [bytes([b]) for b in data]:
-                            self.line_buffers[s].extend(char)
-                            if char == b'\n':                                
-                                line = self.line_buffers[s].decode("iso-8859-1")
-                                self.line_buffers[s].clear()
-
-                                # send to serials
-                                self.callback(self.config["name"], line)
-
-                                # send to other tcp clients connected to this port
-                                # we need to process it here as regular send() framework
-                                # does not know about sockets and we would get a local echo
-                                repeat_message = True
-                                message_type = line[3:6]
-                                if self.accept_messages is not None:
-                                    if message_type not in self.accept_messages:
-                                        repeat_message = False
-                                if self.deny_messages is not None:
-                                    if message_type in self.deny_messages:
-                                        repeat_message = False
-                                if repeat_message:                                                                
-                                    for mq_key in self.message_queues:
-                                        if mq_key != s:
-                                            self.message_queues[mq_key].put(bytes(line, "iso-8859-1"))
-                                            if mq_key not in self.outputs:
-                                                self.outputs.append(mq_key)                                                        
-                    else:
-                        if s in self.outputs:
-                            self.outputs.remove(s)
-                        self.inputs.remove(s)
-                        if s in self.line_buffers:
-                            del self.line_buffers[s]
-                        s.close()
-                        self.message_queues_lock.acquire()
-                        del self.message_queues[s]
-                        self.message_queues_lock.release()                                                
-
-            for s in writable:
-                try:
-                    next_msg = self.message_queues[s].get_nowait()
-                except queue.Empty:
-                    self.outputs.remove(s)
-                else:
-                    s.send(next_msg)
-
-            for s in exceptional:
-                self.inputs.remove(s)
-                if s in self.outputs:
-                    self.outputs.remove(s)
-                if s in self.line_buffers:
-                    del self.line_buffers[s]
-                s.close()
-                self.message_queues_lock.acquire()
-                del self.message_queues[s]
-                self.message_queues_lock.release()
-
-    def send(self, message):
-        message_type = message[3:6]
-        if self.accept_messages is not None:
-            if message_type not in self.accept_messages:
-                return
-        if self.deny_messages is not None:
-            if message_type in self.deny_messages:
-                return
+                    # sentences are short and should go out right away, don't wait for Nagle
+                    connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    # room for bursts from many serials
+                    connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 65536)
+                    # lets kernel notice clients that went away without closing the connection
+                    connection.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                    message_queues_lock.acquire()
+                    message_queues[connection] = collections.deque(maxlen=MAX_WRITE_QUEUE_LEN)
+                    self.selector.register(connection, selectors.EVENT_READ, data=nmea0183_line_buffer())
+                    message_queues_lock.release()
+                    continue
+                if key.data is None:
+                    # shutdown pipe, continue_work is already False
+                    continue
+
+                if mask & selectors.EVENT_READ:
+                    try:
+                        data = s.recv(1024)
+                    except OSError:
+                        data = None
+                    if not data:
+                        self.close_connection(s)
+                        continue
+
+                    for line in key.data.feed(data):
+                        # send to serials
+                        callback(self, line)
+
+                        # send to other tcp clients connected to this port
+                        # we need to process it here as repeat_message() skips the source writer,
+                        # and we pass the client so it does not get a local echo
+                        send(line[3:6], line, s)
+
+                if mask & selectors.EVENT_WRITE:
+                    # leftover from last send and everything queued for this client go out with a single send
+                    message_queues_lock.acquire()
+                    message_queue = message_queues.get(s)
+                    if message_queue is None:
+                        # closed while handling read event
+                        message_queues_lock.release()
+                        continue
+                    pending = unsent_data.pop(s, b"")
+                    if message_queue:
+                        pending += b"".join(message_queue)
+                        message_queue.clear()
+                    if not pending:
+                        self.want_write(s, False)
+                    message_queues_lock.release()
+                    if not pending:
+                        continue
+
+                    try:
+                        sent = s.send(pending)
+                    except BlockingIOError:
+                        sent = 0
+                    except OSError:
+                        self.close_connection(s)
+                        continue
+                    if sent < len(pending):
+                        # socket buffer is full, rest goes first on next send. Write interest stays on.
+                        unsent_data[s] = pending[sent:]
+
+        self.close_all()
+
+    def close_all(self):
+        self.message_queues_lock.acquire()
+        for key in list(self.selector.get_map().values()):
+            if key.data is not None: # clients. Server socket and shutdown pipe are closed below
+                key.fileobj.close()
+        self.message_queues.clear()
+        self.selector.close()
+        self.message_queues_lock.release()
+        self.unsent_data.clear()
+        self.server.close()
+
+        self.shutdown_lock.acquire()
+        os.close(self.shutdown_read)
+        os.close(self.shutdown_write)
+        self.shutdown_read = None
+        self.shutdown_write = None
+        self.shutdown_lock.release()
+
+    # must be called with message_queues_lock held
+    def queue_message(self, connection, message):
+        # as with serials, we drop messages when client does not keep up
+        message_queue = self.message_queues[connection]
+        if len(message_queue) < MAX_WRITE_QUEUE_LEN:
+            message_queue.append(message)
+            self.want_write(connection, True)
+        else:
+            if debug_flag:
+                debug_log(sys.stderr, "{}: ERR: Dropping messages to {} client {}\n".format(sys.argv[0], self.name, connection.fileno()).encode("utf-8"))
+
+    # must be called with message_queues_lock held
+    def want_write(self, connection, enable):
+        key = self.selector.get_key(connection)
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if enable else selectors.EVENT_READ
+        if key.events != events:
+            self.selector.modify(connection, events, data=key.data)
+
+    def close_connection(self, connection):
+        self.message_queues_lock.acquire()
+        self.selector.unregister(connection)
+        del self.message_queues[connection]
+        self.message_queues_lock.release()
+        self.unsent_data.pop(connection, None)
+        connection.close()
+
+    # one of send_* is bound as send() in __init__. source_connection is the client message came from,
+    # so it does not get it back
+    def send_accepted(self, message_type, message, source_connection=None):
+        if message_type in self.accept_messages:
+            self.send_any(message_type, message, source_connection)
+
+    def send_not_denied(self, message_type, message, source_connection=None):
+        if message_type not in self.deny_messages:
+            self.send_any(message_type, message, source_connection)
+
+    def send_any(self, message_type, message, source_connection=None):
         self.message_queues_lock.acquire()
         for mq_key in self.message_queues:                
-            self.message_queues[mq_key].put(bytes(message, "iso-8859-1"))
-            if mq_key not in self.outputs:
-                self.outputs.append(mq_key)
+            if mq_key is not source_connection:
+                self.queue_message(mq_key, message)
         self.message_queues_lock.release()
             
 if __name__ == "__main__":